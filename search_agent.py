@@ -1,31 +1,58 @@
 import streamlit as st
 import os
+import io
+import re
+import time
+import asyncio
+import threading
+from uuid import UUID
+from functools import lru_cache
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from wikipedia import wikipedia as wikipedia_module
+from urllib.parse import unquote, urlsplit
 from langchain_groq import ChatGroq
 from langchain_community.utilities import ArxivAPIWrapper, WikipediaAPIWrapper
 from langchain_community.tools import ArxivQueryRun, WikipediaQueryRun
-from langchain.agents import initialize_agent, AgentType
+from langchain.agents import AgentExecutor, create_tool_calling_agent
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.outputs import LLMResult
 from langchain.tools import Tool
+from langchain.globals import set_llm_cache
+from langchain_community.cache import SQLiteCache
 from langchain_community.callbacks.streamlit import StreamlitCallbackHandler 
-from googlesearch import search
 
 
 # Constants
 MAX_ITERATIONS = 5      
 MAX_SEARCH_RESULTS = 3  
 GROQ_API = os.getenv("GROQ_API")
+GOOGLE_SEARCH_URL = "https://www.google.com/search"
+GOOGLE_USER_AGENT = "Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.0)"
+GOOGLE_REQUESTS_PER_MINUTE = 30
+GOOGLE_BURST = 5
+SEARCH_TIMEOUT = 10.0
+SEARCH_CACHE_TTL = 3600
+SEARCH_CACHE_ENTRIES = 256
+LLM_CACHE_PATH = ".langchain.db"
+HISTORY_WINDOW = 6
+SUMMARY_CACHE_ENTRIES = 128
+
+_RESULT_LINK_RE = re.compile(r'href="/url\?q=(https?://[^&"]+)')
+# A "Source:" line, or any other line mentioning a product marker or a price
+_MARKDOWN_LINE_RE = re.compile(r'^(?:Source: ?(?P<src>.*)|(?P<item>.*(?:RYOBI|PCL|\$).*))$', re.M)
 
 
 PROMPT_TEMPLATES = {
-    "Product Search": """You are a product analyst. Analyze this product: {query}
+    "Product Search": """You are a product analyst. Analyze the product in the user query below.
     
     TASK:
     1. Extract product details from markdown content
     2. Identify: full product name, category, price, and URL
     3. Format response precisely
     
-    Available information from search:
-    {search_results}
-    
     INSTRUCTIONS:
     - IMPORTANT: Only use prices that appear directly in the search results
     - If no price is found, use "Price not found" instead of guessing
@@ -37,32 +64,26 @@ PROMPT_TEMPLATES = {
     OUTPUT FORMAT:
     [Product Name]<||>[Category]<||>[Price]<||>[URL]""",
     
-    "Location Info": """You are a geographic analyst. Analyze this query: {query}
+    "Location Info": """You are a geographic analyst. Analyze the user query below.
     
     Your task:
     1. Determine the type of location (country, state, city, etc.)
     2. Search for accurate population and area data
     3. Format response precisely
     
-    Available information from search:
-    {search_results}
-    
     Rules:
     - For US locations, specify if it's a state or city
     - Population should be the most recent available
     - Area should include the unit (km² or sq mi)
     - Be accurate with administrative divisions""",
     
-    "Company Details": """You are a business analyst. Analyze this query: {query}
+    "Company Details": """You are a business analyst. Analyze the user query below.
     
     Your task:
     1. Research company information
     2. Find company website and details
     3. Format response precisely
     
-    Available information from search:
-    {search_results}
-    
     Rules:
     - Look for company website first
     - Extract industry from company description or website
@@ -73,107 +94,274 @@ PROMPT_TEMPLATES = {
     OUTPUT FORMAT:
     [Company Name]<||>[Industry]<||>[Revenue/Status]<||>[Location/Website]""",
     
-    "Custom": """You are an information analyst. Analyze this query: {query}
+    "Custom": """You are an information analyst. Analyze the user query below.
     
     Your task:
     1. Search for relevant information
     2. Extract specific details matching the requested format
     3. Format response precisely
     
-    Available information from search:
-    {search_results}
-    
     Rules:
     - Focus on accuracy and relevance
     - Include source URLs when available
     - Follow the exact format requested"""
 }
 
-def create_formatted_prompt(query: str, template_option: str, format_input: str) -> str:
-    """Create a formatted prompt based on the selected template"""
+FORMAT_TEMPLATES = {
+    "Product Search": {
+        "format": "product_name<||>category<||>price<||>url",
+        "example": "DW6SS is a dishwasher<||>Appliances<||>$299.99<||>https://example.com",
+        "description": "For searching product information"
+    },
+    "Location Info": {
+        "format": "location_name<||>location_type<||>Country<||>population<||>area",
+        "example": "Texas<||>US State<||>United States of America<||>30.5 million<||>695,662 km²",
+        "description": "For geographic information. Location type can be: Country, US State, City, etc."
+    },
+    "Company Details": {
+        "format": "company<||>industry<||>revenue<||>headquarters",
+        "example": "Apple<||>Technology<||>$365.8B<||>Cupertino, CA",
+        "description": "For company information"
+    }
+}
+
+# The static template travels as the system message so every request shares
+# the same cacheable prefix; only the human message changes between requests
+AGENT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "{instructions}"),
+    ("human", "{input}"),
+    MessagesPlaceholder("agent_scratchpad")
+])
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and a web search assistant.
+Fold the new messages into the current summary and keep it to a few sentences.
+Keep every product, company, place and output format the user asked about.
+
+Current summary:
+{summary}
+
+New messages:
+{transcript}"""
+
+@lru_cache(maxsize=64)
+def create_formatted_prompt(template_option: str, format_input: str) -> str:
+    """Static system instructions for the selected template and output format"""
     base_prompt = PROMPT_TEMPLATES.get(template_option, PROMPT_TEMPLATES["Custom"])
-    formatted_prompt = base_prompt.format(
-        query=query,
-        search_results="{search_results}" 
-    )
-    return f"{formatted_prompt}\nRequired output format: {format_input}"
+    return f"{base_prompt}\nRequired output format: {format_input}"
+
+def create_user_message(query: str, history: str = "") -> str:
+    """Per-request human message: conversation context followed by the query"""
+    history_block = f"Conversation so far:\n{history}\n\n" if history else ""
+    return f"{history_block}User query: {query}"
+
+@lru_cache(maxsize=64)
+def _pad_suffix(format_input: str) -> str:
+    """N/A placeholders for every field after the first in the requested format"""
+    return "<||>N/A" * format_input.count("<||>")
+
+def _normalize_query(query: str) -> str:
+    """Cache key for a query; the original text is what gets sent to the APIs"""
+    return query.strip().lower()
+
+@st.cache_resource
+def get_http_session():
+    """Pooled session so repeat lookups reuse TCP/TLS connections"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-arxiv_wrapper = ArxivAPIWrapper(top_k_results=1, doc_content_chars_max=500)
-arxiv = ArxivQueryRun(api_wrapper=arxiv_wrapper)
+@st.cache_resource
+def get_arxiv_wrapper():
+    return ArxivAPIWrapper(top_k_results=1, doc_content_chars_max=500)
 
-api_wrapper = WikipediaAPIWrapper(top_k_results=1, doc_content_chars_max=500)
-wiki = WikipediaQueryRun(api_wrapper=api_wrapper)
+@st.cache_resource
+def get_wiki_wrapper():
+    # The wikipedia package issues module-level requests.get calls; route them through the pool
+    wikipedia_module.requests = get_http_session()
+    return WikipediaAPIWrapper(top_k_results=1, doc_content_chars_max=500)
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_ENTRIES, show_spinner=False)
+def _cached_arxiv_search(key: str, _query: str) -> str:
+    result = get_arxiv_wrapper().run(_query)
+    # The wrapper reports API failures as text; raise so st.cache_data does not keep them
+    if result.startswith("Arxiv exception:"):
+        raise RuntimeError(result)
+    return result
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_ENTRIES, show_spinner=False)
+def _cached_wiki_search(key: str, _query: str) -> str:
+    return get_wiki_wrapper().run(_query)
+
+def arxiv_search_tool(query: str) -> str:
+    """Arxiv lookup cached on the normalized query; failures are reported, not cached"""
+    try:
+        return _cached_arxiv_search(_normalize_query(query), query)
+    except Exception as e:
+        return str(e)
+
+def wiki_search_tool(query: str) -> str:
+    """Wikipedia lookup cached on the normalized query"""
+    return _cached_wiki_search(_normalize_query(query), query)
+
+async def aarxiv_search_tool(query: str) -> str:
+    return await asyncio.to_thread(arxiv_search_tool, query)
+
+async def awiki_search_tool(query: str) -> str:
+    return await asyncio.to_thread(wiki_search_tool, query)
+
+@lru_cache(maxsize=4096)
+def _domain(url: str) -> str:
+    """Host part of a URL, or the URL itself when it has none"""
+    return urlsplit(url).netloc or url
 
 def format_to_markdown(search_results: str) -> str:
     """Convert search results to markdown format"""
-    markdown_lines = []
+    buffer = io.StringIO()
     current_source = None
     
-    for line in search_results.split('\n'):
-        line = line.strip()
-        if line.startswith('Source:'):
-            current_source = line.replace('Source:', '').strip()
-
-            domain = current_source.split('/')[2] if '/' in current_source else current_source
-            markdown_lines.append(f"\n### [{domain}]({current_source})")
-        elif current_source and line:
+    for match in _MARKDOWN_LINE_RE.finditer(search_results):
+        source = match.group('src')
+        if source is not None:
+            current_source = source
+            line = f"\n### [{_domain(current_source)}]({current_source})"
+        elif current_source:
+            line = f"- {match.group('item')}"
+        else:
+            continue
 
-            if 'RYOBI' in line or 'PCL' in line or '$' in line:
-                markdown_lines.append(f"- {line}")
+        if buffer.tell():
+            buffer.write("\n")
+        buffer.write(line)
     
-    return "\n".join(markdown_lines)
+    return buffer.getvalue()
 
-def google_search_tool(query: str, num: int = MAX_SEARCH_RESULTS) -> str:
+class TokenBucket:
+    """Rate limiter that allows bursts up to `capacity` and refills at `rate` tokens per second"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        # Google fetches run in worker threads, so guard the bucket with a thread lock
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take a token, returning how long the caller must wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+
+@st.cache_resource
+def get_google_bucket():
+    return TokenBucket(rate=GOOGLE_REQUESTS_PER_MINUTE / 60, capacity=GOOGLE_BURST)
+
+@st.cache_resource
+def get_google_client():
+    """One pooled client per process so Google fetches reuse connections"""
+    return httpx.Client(
+        headers={"User-Agent": GOOGLE_USER_AGENT},
+        timeout=SEARCH_TIMEOUT,
+        follow_redirects=True
+    )
+
+def _fetch_google(query: str, num: int = MAX_SEARCH_RESULTS) -> list:
+    """Fetch a Google results page and return up to `num` result URLs"""
+    get_google_bucket().acquire()
+    response = get_google_client().get(GOOGLE_SEARCH_URL, params={"q": query, "num": num, "hl": "en"})
+    response.raise_for_status()
+
+    links = []
+    for match in _RESULT_LINK_RE.finditer(response.text):
+        url = unquote(match.group(1))
+        if "google." in _domain(url) or url in links:
+            continue
+        links.append(url)
+        if len(links) == num:
+            break
+    return links
+
+def _format_result(url: str) -> str:
+    """Plain-text block describing one search result"""
+    domain = _domain(url)
+    info = f"Company Website: {domain}" if domain.endswith(('.com', '.org')) else ""
+    return f"Source: {url}\nWebsite: {domain}\nInfo: {info}"
+
+def _google_search(query: str, num: int = MAX_SEARCH_RESULTS) -> str:
     """Enhanced Google search with markdown formatting and content extraction"""
-    try:
-        if "company" in query.lower() or "llc" in query.lower():
-            company_name = query.replace("llc", "").strip()
-            company_query = f"{company_name} company website OR {company_name}.com"
-            specific_query = f"{company_name} company (industry OR revenue OR headquarters)"
-            
-            results = list(search(company_query, num=2, stop=2, pause=2.0, lang='en'))
-            results.extend(list(search(specific_query, num=2, stop=2, pause=2.0, lang='en')))
-        else:
-            results = list(search(query, num=num, stop=num, pause=2.0, lang='en'))
+    if "company" in query.lower() or "llc" in query.lower():
+        company_name = query.replace("llc", "").strip()
+        company_query = f"{company_name} company website OR {company_name}.com"
+        specific_query = f"{company_name} company (industry OR revenue OR headquarters)"
+        
+        # One roundtrip for both intents; _fetch_google already drops duplicate URLs
+        results = _fetch_google(f"({company_query}) OR ({specific_query})", num=4)
+    else:
+        results = _fetch_google(query, num=num)
 
 
-        formatted_results = []
-        for url in results:
-            try:
-                domain = url.split('/')[2]
-                info = []
-                
-                if domain.endswith('.com') or domain.endswith('.org'):
-                    info.append(f"Company Website: {domain}")
-                
-                formatted_results.append(f"""
-                Source: {url}
-                Website: {domain}
-                Info: {' '.join(info)}
-                """)
-            except Exception as e:
-                continue
-
-        markdown_content = format_to_markdown("\n".join(formatted_results))
-        return markdown_content
+    formatted_results = "\n".join(_format_result(url) for url in results)
+    markdown_content = format_to_markdown(formatted_results)
+    return markdown_content
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_ENTRIES, show_spinner=False)
+def _cached_google_search(key: str, num: int, _query: str) -> str:
+    return _google_search(_query, num)
+
+def google_search_tool(query: str, num: int = MAX_SEARCH_RESULTS) -> str:
+    """Google search cached on the normalized query; failures are reported, not cached"""
+    try:
+        return _cached_google_search(_normalize_query(query), num, query)
     except Exception as e:
         return f"Error in Google Search: {str(e)}"
 
+async def agoogle_search_tool(query: str, num: int = MAX_SEARCH_RESULTS) -> str:
+    return await asyncio.to_thread(google_search_tool, query, num)
 
-#status_placeholder = st.empty()
-google_tool = Tool(
-    name="Google Search",
-    func=google_search_tool,
-    description="Busca información en Google."
-)
+@st.cache_resource
+def get_tools():
+    """Build the agent's tools once per process"""
+    arxiv = ArxivQueryRun(api_wrapper=get_arxiv_wrapper())
+    wiki = WikipediaQueryRun(api_wrapper=get_wiki_wrapper())
 
-st.title("🔎Web Search")
+    arxiv_tool = Tool(
+        name=arxiv.name,
+        func=arxiv_search_tool,
+        coroutine=aarxiv_search_tool,
+        description=arxiv.description
+    )
 
-#def update_status(message):
-    #"""Update status message with timestamp"""
-    #status_placeholder.info(f"{time.strftime('%H:%M:%S')} - {message}")
+    wiki_tool = Tool(
+        name=wiki.name,
+        func=wiki_search_tool,
+        coroutine=awiki_search_tool,
+        description=wiki.description
+    )
 
-with st.sidebar:
+    google_tool = Tool(
+        name="google_search",
+        func=google_search_tool,
+        coroutine=agoogle_search_tool,
+        description="Busca información en Google."
+    )
+
+    return (arxiv_tool, wiki_tool, google_tool)
+
+st.title("🔎Web Search")
+
+@st.fragment
+def response_format_sidebar():
+    """Sidebar controls; editing them reruns only this fragment, not the whole app"""
     st.header("Response Format Configuration")
     
     template_option = st.selectbox(
@@ -181,24 +369,6 @@ with st.sidebar:
         ["Custom", "Product Search", "Location Info", "Company Details"]
     )
     
-    templates = {
-        "Product Search": {
-            "format": "product_name<||>category<||>price<||>url",
-            "example": "DW6SS is a dishwasher<||>Appliances<||>$299.99<||>https://example.com",
-            "description": "For searching product information"
-        },
-        "Location Info": {
-            "format": "location_name<||>location_type<||>Country<||>population<||>area",
-            "example": "Texas<||>US State<||>United States of America<||>30.5 million<||>695,662 km²",
-            "description": "For geographic information. Location type can be: Country, US State, City, etc."
-        },
-        "Company Details": {
-            "format": "company<||>industry<||>revenue<||>headquarters",
-            "example": "Apple<||>Technology<||>$365.8B<||>Cupertino, CA",
-            "description": "For company information"
-        }
-    }
-    
     if template_option == "Custom":
         format_input = st.text_input(
             "Enter your custom format (use <||> as separator):",
@@ -209,15 +379,18 @@ with st.sidebar:
             "value1<||>value2<||>value3"
         )
     else:
-        format_input = templates[template_option]["format"]
-        example_input = templates[template_option]["example"]
-        st.info(templates[template_option]["description"])
+        format_input = FORMAT_TEMPLATES[template_option]["format"]
+        example_input = FORMAT_TEMPLATES[template_option]["example"]
+        st.info(FORMAT_TEMPLATES[template_option]["description"])
     
     st.divider()
     st.caption("Format Guide:")
     st.code(f"Format: {format_input}\nExample: {example_input}")
+    return template_option, format_input
 
-    #update_status("Ready to search!")
+# Fragments cannot write to the sidebar themselves, so call this one from inside it
+with st.sidebar:
+    template_option, format_input = response_format_sidebar()
 
 if "messages" not in st.session_state:
     st.session_state["messages"] = [
@@ -227,52 +400,189 @@ if "messages" not in st.session_state:
 for msg in st.session_state.messages:
     st.chat_message(msg["role"]).write(msg['content'])
 
-def create_search_agent(tools, llm):
-    return initialize_agent(
-        tools, 
-        llm, 
-        agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, 
+class InlineStreamlitCallbackHandler(StreamlitCallbackHandler):
+    """Run callbacks on the script thread so async agent runs can still draw"""
+    run_inline = True
+
+class TokenUsageCallbackHandler(AsyncCallbackHandler):
+    """Sum token usage from each LLM call, keeping LLM-cache hits apart from billed calls"""
+
+    def __init__(self):
+        self.usage = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+        self.cached_usage = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+        self._streamed_runs = set()
+
+    @staticmethod
+    def _add(usage: dict, input_tokens: int, output_tokens: int):
+        usage["input_tokens"] += input_tokens
+        usage["output_tokens"] += output_tokens
+        usage["total_tokens"] += input_tokens + output_tokens
+
+    async def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs) -> None:
+        self._streamed_runs.add(run_id)
+
+    async def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs) -> None:
+        # Cache hits never stream tokens, and their replayed usage carries total_cost=0
+        from_cache = run_id not in self._streamed_runs
+        found = False
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    cached = from_cache or usage.get("total_cost") == 0
+                    target = self.cached_usage if cached else self.usage
+                    self._add(target, usage["input_tokens"], usage["output_tokens"])
+                    found = True
+
+        token_usage = (response.llm_output or {}).get("token_usage")
+        if not found and token_usage:
+            target = self.cached_usage if from_cache else self.usage
+            self._add(target, token_usage.get("prompt_tokens", 0), token_usage.get("completion_tokens", 0))
+
+@st.cache_resource
+def get_llm_cache():
+    return SQLiteCache(database_path=LLM_CACHE_PATH)
+
+set_llm_cache(get_llm_cache())
+
+@st.cache_resource
+def get_llm():
+    return ChatGroq(groq_api_key=GROQ_API, model_name="gemma2-9b-it", streaming=True)
+
+@st.cache_resource
+def get_agent(_llm, _tools):
+    """Build the agent once per process; underscored args are not hashed"""
+    tools = list(_tools)
+    agent = create_tool_calling_agent(_llm, tools, AGENT_PROMPT)
+    return AgentExecutor(
+        agent=agent,
+        tools=tools,
         handle_parsing_errors=True,
         max_iterations=MAX_ITERATIONS,
-        early_stopping_method='generate'
+        # Tool-calling agents only support forced stops
+        early_stopping_method='force',
+        # ainvoke goes through agenerate, which consults the global LLM cache; astream skips it.
+        # Tokens still stream to astream_events because ChatGroq has streaming=True
+        stream_runnable=False
     )
 
+def _transcript(messages: list) -> str:
+    return "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL, max_entries=SUMMARY_CACHE_ENTRIES, show_spinner=False)
+def summarize_history(summary: str, transcript: str) -> str:
+    """Fold a block of messages into the running summary"""
+    prompt = SUMMARY_PROMPT.replace("{summary}", summary or "(none)").replace("{transcript}", transcript)
+    return get_llm().invoke(prompt).content
+
+def build_history_context(messages: list) -> str:
+    """The running summary followed by the messages not yet folded into it"""
+    summary = st.session_state.get("history_summary", "")
+    recent = messages[st.session_state.get("summarized_count", 0):]
+    parts = []
+    if summary:
+        parts.append(f"Summary of earlier turns: {summary}")
+    if recent:
+        parts.append(_transcript(recent))
+    return "\n".join(parts)
+
+def update_history_summary(messages: list):
+    """Fold the oldest HISTORY_WINDOW unsummarized messages once twice that many have piled up"""
+    summarized = st.session_state.get("summarized_count", 0)
+    if len(messages) - summarized < 2 * HISTORY_WINDOW:
+        return
+    block = messages[summarized:summarized + HISTORY_WINDOW]
+    st.session_state["history_summary"] = summarize_history(
+        st.session_state.get("history_summary", ""),
+        _transcript(block)
+    )
+    st.session_state["summarized_count"] = summarized + HISTORY_WINDOW
+
+async def stream_agent(agent, agent_input: dict, callbacks: list, result: dict):
+    """Yield model tokens as they arrive and store the agent's final answer in `result`"""
+    async for event in agent.astream_events(
+        agent_input,
+        config={"callbacks": callbacks},
+        version="v2"
+    ):
+        if event["event"] == "on_chat_model_stream":
+            content = event["data"]["chunk"].content
+            if content:
+                yield content
+        elif event["event"] == "on_chat_model_end":
+            # A last turn that still asks for tools means MAX_ITERATIONS ended the run, not the model
+            result["stopped"] = bool(getattr(event["data"]["output"], "tool_calls", None))
+        elif event["event"] == "on_chain_end" and not event["parent_ids"]:
+            result["output"] = event["data"]["output"]["output"]
+
+def iter_async(agen):
+    """Drive an async generator from Streamlit's synchronous script thread"""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
 if prompt := st.chat_input(placeholder="Enter Your Question Here"):
     st.session_state.messages.append({"role": "user", "content": prompt})
     st.chat_message("user").write(prompt)
 
-    llm = ChatGroq(groq_api_key=GROQ_API, model_name="gemma2-9b-it", streaming=True)
-    tools = [arxiv, wiki, google_tool]
+    llm = get_llm()
 
     with st.chat_message("assistant"):
-        st_cb = StreamlitCallbackHandler(st.container(), expand_new_thoughts=False)
+        st_cb = InlineStreamlitCallbackHandler(st.container(), expand_new_thoughts=False)
         try:
-            formatted_prompt = create_formatted_prompt(
-                prompt,
-                template_option,
-                format_input
-            )
+            # Skip the greeting and the prompt that was just appended
+            history = build_history_context(st.session_state.messages[1:-1])
+            agent_input = {
+                "instructions": create_formatted_prompt(template_option, format_input),
+                "input": create_user_message(prompt, history)
+            }
 
-            search_agent = create_search_agent(tools, llm)
-            try:
-                response = search_agent.run([{"role": "user", "content":formatted_prompt}], callbacks=[st_cb])
-            except Exception as e:
-                if "maximum iterations" in str(e).lower():
-                    response = "Search stopped due to too many iterations. Please try a more specific query."
-                else:
-                    raise e
+            search_agent = get_agent(llm, get_tools())
+            response_area = st.empty()
+            result = {}
+            usage_cb = TokenUsageCallbackHandler()
+            with response_area:
+                streamed = st.write_stream(
+                    iter_async(stream_agent(search_agent, agent_input, [st_cb, usage_cb], result))
+                )
+            if result.get("stopped"):
+                response = "Search stopped due to too many iterations. Please try a more specific query."
+            else:
+                response = result.get("output", streamed)
             
             if "<||>" not in response:
-                fields = format_input.split("<||>")
-                response = "<||>".join([response] + ["N/A"] * (len(fields) - 1))
+                response += _pad_suffix(format_input)
             
             st.session_state.messages.append({'role': 'assistant', "content": response})
-            st.write(response)
-            
+            response_area.write(response)
 
-            #update_status("Search completed successfully!")
-            
+            session_usage = st.session_state.setdefault("usage", {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0})
+            session_cached = st.session_state.setdefault("cached_usage", {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0})
+            for key, value in usage_cb.usage.items():
+                session_usage[key] += value
+            for key, value in usage_cb.cached_usage.items():
+                session_cached[key] += value
+            usage_caption = (
+                f"Tokens: {usage_cb.usage['input_tokens']} in / {usage_cb.usage['output_tokens']} out "
+                f"(session total: {session_usage['total_tokens']})"
+            )
+            if usage_cb.cached_usage["total_tokens"]:
+                usage_caption += f" · {usage_cb.cached_usage['total_tokens']} served from cache, not billed"
+            st.caption(usage_caption)
+
+            # Summarize after the answer is shown so it never delays the first token
+            try:
+                update_history_summary(st.session_state.messages[1:])
+            except Exception:
+                # The answer already stands; summarized_count is untouched, so the fold is retried next turn
+                pass
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
-            #update_status("Search failed!")
 